@@ -1,37 +1,90 @@
 #!/bin/python3
 import argparse
+import atexit
 import os
 import hashlib
 import logging
-import math
-import pickle
-import json
+import mmap
+import queue
+import signal
+import sys
+import threading
+import sqlite3
 import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import timedelta
 
-def migrate_database():
-  if not os.path.exists(hash_file_path):
-    if os.path.exists(hash_file_path_legacy):
-      migrate = ""
-      while migrate != "y" and migrate != "n":
-        migrate = input("Unmigrated pickle file found. Do you wish to migrate it? (y/n): ").lower()
-      if migrate == "n":
-        print("Support for the old cache format has been dropped. Migration is necessary.")
-        exit()
-      legacy_data = load_hashes_legacy(hash_file_path_legacy)
-      changed_data = dict()
-      
-      # json cannot use tuples as keys so we use a string
-      for key in legacy_data:
-        basename, filesize = key
-        new_key = f"{filesize} {basename}"
-        changed_data[new_key] = legacy_data[key]
-      # previously, only sha1 was supported, so it follows that all hashes in the pickle file are sha1 hashes
-      data = {"sha1": changed_data}
-      save_hashes(hash_file_path, data)
-      
-      print("renaming legacy pickle file")
-      os.rename(hash_file_path_legacy, os.path.join(directory, "hashes_legacy.p"))
+try:
+  import blake3
+except ImportError:
+  blake3 = None
+
+try:
+  import liburing
+except ImportError:
+  liburing = None
+
+def liburing_is_supported():
+  # The API of the binding changed completely between releases, only the one _hash_file_uring is written for is used
+  try:
+    version = tuple(int(part) for part in liburing.__version__.split(".")[:3])
+  except (AttributeError, ValueError):
+    return False
+  return version >= (2026, 3, 30) and all(hasattr(liburing, name) for name in (
+    "Ring", "Cqe", "io_uring_queue_init", "io_uring_queue_exit", "io_uring_get_sqe", "io_uring_prep_read",
+    "io_uring_submit", "io_uring_wait_cqe", "io_uring_cqe_seen"))
+
+if liburing is not None and not liburing_is_supported():
+  liburing = None
+
+def cpu_has_sha_extensions():
+  # OpenSSL uses the SHA extensions (SHA-NI on x86, the sha1 feature on arm) on its own if the cpu has them
+  try:
+    with open("/proc/cpuinfo") as f:
+      for line in f:
+        if line.startswith(("flags", "Features")):
+          return "sha_ni" in line.split() or "sha1" in line.split()
+  except OSError:
+    pass
+  return False
+
+# duplicate detection needs no collision resistance against attackers, so the fastest hash available is the default:
+# blake3, else sha1 if the cpu computes it in hardware (about twice as fast as blake2b), else blake2b
+if blake3 is not None:
+  DEFAULT_HASH_NAME = "blake3"
+elif cpu_has_sha_extensions():
+  DEFAULT_HASH_NAME = "sha1"
+else:
+  DEFAULT_HASH_NAME = "blake2b"
+
+SAMPLE_SIZE = 65536 # bytes from the start and from the end compared before a file is hashed completely
+SAMPLE_HASH_NAME = "blake2b-head-tail" # cache entry of the sample hashes
+
+PROGRESS_INTERVAL = 0.5 # minimum seconds between two progress lines
+
+BATCH_FILE_SIZE = 1 << 20 # files up to this size are handed to the hashing threads in batches
+BATCH_LENGTH = 64
+
+SINGLE_READ_THRESHOLD = 256 << 10 # files up to this size are read and hashed in one call
+MMAP_THRESHOLD = 1 << 20 # files from this size on are mapped into memory instead of read in chunks
+
+TREE_HASH_THRESHOLD = 16 << 20 # blake3 hashes files larger than this on all cores
+
+READ_AHEAD_THRESHOLD = 16 << 20 # files larger than this are read ahead in a separate thread
+READ_AHEAD_BUF_SIZE = 1 << 20
+READ_AHEAD_DEPTH = 4 # buffers in flight between the reader and the hashing thread
+URING_DEPTH = 8 # reads in flight per file with io_uring
+_stranded_buffers = [] # io_uring buffers that could still be written by the kernel
+
+# size and nlink are taken from the symlink target, like the content that gets hashed
+FileEntry = namedtuple("FileEntry", ["path", "size", "nlink", "is_symlink", "mtime_ns", "dev", "ino"])
+
+def retire_legacy_cache():
+  # the json cache identified files by name and size only, its hashes cannot be reused
+  if os.path.exists(hash_file_path):
+    print("The cache '"+hash_file_path+"' identifies files by name and size only and is no longer used, renaming it to hashes_legacy.json")
+    os.rename(hash_file_path, os.path.join(directory, "hashes_legacy.json"))
 
 def main():
   parser = argparse.ArgumentParser(description='Find duplicate files in destination of files in source,'+
@@ -50,27 +103,40 @@ def main():
   parser.add_argument('--follow-symlinks', dest="follow_symlinks", action='store_true',
                       help='Set this to follow symlinks, can result in redundant work or problems. Default: false')
 
+  parser.add_argument('--min-size', dest="min_size", type=int, default=1,
+                      help="Ignore files smaller than this many bytes. Default: 1")
+
+  parser.add_argument('--ext', dest="extensions", action="append",
+                      help="Only consider files with this extension, can be given multiple times (e.g. --ext mkv --ext mp4). Default: all files")
+
   parser.add_argument('--no-cache', dest="no_cache", action="store_true",
-                      help="Deactivate caching based on filename-filesize combination. Caching can cause problems, but improves speed immensely for repeated executions")
+                      help="Deactivate caching based on path, size and modification time of the files. Caching improves speed immensely for repeated executions")
 
   parser.add_argument('--no-source-cache', dest="no_source_cache", action="store_true",
-                      help="Deactivate caching based on filename-filesize combination for the source directory.")
+                      help="Deactivate caching for the source directory.")
 
   parser.add_argument('--no-destination-cache', dest="no_destination_cache", action="store_true",
-                      help="Deactivate caching based on filename-filesize combination for the destination directory.")
+                      help="Deactivate caching for the destination directory.")
+
+  parser.add_argument('-j', '--jobs', dest="jobs", type=int, default=os.cpu_count(),
+                      help="Number of files hashed in parallel. Default: number of cpus")
+
+  parser.add_argument('--processes', dest="processes", action="store_true",
+                      help="Hash in separate processes instead of threads. Faster for many small files, where the python overhead per file limits threads.")
 
   parser.add_argument('--print-hashes', dest="print_hashes", action="store_true",
-                      help="Prints list of all files for debugging purposes.")
+                      help="Prints the hashes of all candidate files (those left after the size and sample comparison) for debugging purposes.")
   
   
   group = parser.add_mutually_exclusive_group()
 
-  hash_function = None
-
-  group.add_argument('--sha1', dest=hash_function, action='store_const', const=hashlib.sha1, help='Use sha1 hashes (default)')
-  group.add_argument('--sha256', dest=hash_function, action='store_const', const=hashlib.sha256, help='Use sha256 hashes')
-  group.add_argument('--sha512', dest=hash_function, action='store_const', const=hashlib.sha512, help='Use sha512S hashes')
-  group.add_argument('--md5', dest=hash_function, action='store_const', const=hashlib.md5, help='Use md5 hashes')
+  group.add_argument('--sha1', dest="hash_function_name", action='store_const', const="sha1", help='Use sha1 hashes (default without the blake3 package if the cpu has sha extensions)')
+  group.add_argument('--sha256', dest="hash_function_name", action='store_const', const="sha256", help='Use sha256 hashes')
+  group.add_argument('--sha512', dest="hash_function_name", action='store_const', const="sha512", help='Use sha512 hashes')
+  group.add_argument('--md5', dest="hash_function_name", action='store_const', const="md5", help='Use md5 hashes')
+  group.add_argument('--blake2b', dest="hash_function_name", action='store_const', const="blake2b", help='Use blake2b hashes (default without the blake3 package and cpu sha extensions)')
+  group.add_argument('--blake3', dest="hash_function_name", action='store_const', const="blake3", help='Use blake3 hashes (default, requires the blake3 package)')
+  parser.set_defaults(hash_function_name=DEFAULT_HASH_NAME)
 
   parser.add_argument(
       '-d', '--debug',
@@ -88,11 +154,29 @@ def main():
   follow_symlinks = args.follow_symlinks
   softlink = args.softlink
   hardlink = args.hardlink
-  if hash_function is None:
-    hash_function = hashlib.sha1
-  hash_function_name = hash_function.__name__[8:]
-  if not hash_function_name in hashes:
-    hashes[hash_function_name] = dict()
+  hash_function_name = args.hash_function_name
+  if hash_function_name == "blake3" and blake3 is None:
+    print("blake3 hashes require the blake3 package (pip install blake3).")
+    exit()
+  if hash_function_name == "blake3":
+    logging.info("Hashing with blake3 "+blake3.__version__+" on all cpu cores.")
+  elif logging.getLogger().isEnabledFor(logging.INFO):
+    try:
+      import ssl # only for the version string, hashlib works without the ssl module
+      backend = ssl.OPENSSL_VERSION
+    except ImportError:
+      backend = "hashlib"
+    logging.info("Hashing with "+hash_function_name+" from "+backend+", cpu sha extensions: "+
+                 ("yes" if cpu_has_sha_extensions() else "no"))
+
+  global database
+  database = open_database(hash_db_path)
+  atexit.register(flush_hashes)
+  signal.signal(signal.SIGINT, _exit_on_interrupt)
+  retire_legacy_cache()
+  if logging.getLogger().isEnabledFor(logging.INFO):
+    # counting scans the whole table, which only pays off when it is shown
+    logging.info("Loaded "+str(database.execute("SELECT COUNT(*) FROM hashes").fetchone()[0])+" previously calculated hashes.")
 
   if softlink and hardlink:
     print("Cannot create soft- and hardlinks at the same time. Choose one.")
@@ -107,55 +191,76 @@ def main():
   print("Use destination cache: "+str(use_destination_cache))
   print("-"*40)
 
-  source_files = get_all_files(args.source)
-  destination_files = get_all_files(args.destination)
-
-  source_hashes = dict()      # hash: abspath
-  destination_hashes = dict() # hash: abspath
-  
-  source_files_unhashed_size = sum(map(lambda x: safe_file_size(x), filter(lambda x: (not has_file_hash(x, hash_function_name)) or (not use_source_cache), source_files)))
-  source_files_hashed_size = 0
-
-  destination_files_unhashed_size = sum(map(lambda x: safe_file_size(x), filter(lambda x: (not has_file_hash(x, hash_function_name)) or (not use_destination_cache), destination_files)))
-  destination_files_hashed_size = 0
-
-  start_time = time.time()
-  
-  for sf in source_files:
-    if not os.path.islink(sf) or follow_symlinks:
-      add = (not has_file_hash(sf, hash_function_name)) or (not use_source_cache)
-
-      hash = get_file_hash(sf, hash_function, use_source_cache)
-      if add:
-        source_files_hashed_size += safe_file_size(sf)
-        time_used = (time.time() - start_time)
-        time_left = (time_used / (source_files_hashed_size / source_files_unhashed_size)) - time_used
-        print("Source-file hashed so far: " + ("%.2f"% (source_files_hashed_size/float(10**9) ) ) +
-        "/" + ("%.2f"% (source_files_unhashed_size/float(10**9) ) ) +
-        " GB (" + ("%.2f"% (source_files_hashed_size*100/source_files_unhashed_size) ) + "%)"+
-        " avg. Speed: "+("%.2f"% (source_files_hashed_size / time_used / float(10**6))) + " MB/s"
-        " ETA: "+calculate_elapsed_time(time_left))
-      if hash is not None:
-        source_hashes[hash] = os.path.abspath(sf)
-
-  start_time = time.time()
-
-  for df in destination_files:
-    if not os.path.islink(df) or follow_symlinks:
-      add = (not has_file_hash(df, hash_function_name)) or (not use_destination_cache)
-      hash = get_file_hash(df, hash_function, use_destination_cache)
-      if add:
-        destination_files_hashed_size += safe_file_size(sf)
-        time_used = (time.time() - start_time)
-        time_left = (time_used / (destination_files_hashed_size / destination_files_unhashed_size)) - time_used
-        print("Destination-file hashed so far: " + ("%.2f"% (destination_files_hashed_size/float(10**9) ) ) +
-        "/" + ("%.2f"% (destination_files_unhashed_size/float(10**9) ) ) +
-        " GB (" + ("%.2f"% (destination_files_hashed_size*100/destination_files_unhashed_size) ) + "%)"+
-        " avg. Speed: "+("%.2f"% (destination_files_hashed_size / time_used / float(10**6))) + " MB/s"
-        " ETA: "+calculate_elapsed_time(time_left))
+  extensions = None
+  if args.extensions:
+    extensions = {"." + extension.lstrip(".").lower() for extension in args.extensions}
+  source_work = get_all_files(args.source, follow_symlinks, args.min_size, extensions)
+  destination_work = get_all_files(args.destination, follow_symlinks, args.min_size, extensions)
+
+  # Files found on both sides (overlapping folders, hardlinks between them) are the same file,
+  # they need no hashing and must not be replaced by a link to themselves
+  source_inode_keys = {_inode_key(sf) for sf in source_work}
+  destination_work = [df for df in destination_work if _inode_key(df) not in source_inode_keys]
+
+  if hardlink:
+    # Hardlinks cannot cross filesystems, files on a device found only on one side can never be linked
+    common_devices = {sf.dev for sf in source_work} & {df.dev for df in destination_work}
+    source_count, destination_count = len(source_work), len(destination_work)
+    source_work = [sf for sf in source_work if sf.dev in common_devices]
+    destination_work = [df for df in destination_work if df.dev in common_devices]
+    logging.info("Skipping "+str(source_count-len(source_work))+" source and "+str(destination_count-len(destination_work))+
+                 " destination files on devices found only on one side, hardlinks cannot cross filesystems.")
+
+  # Files can only match a file of the same size on the other side
+  common_sizes = {sf.size for sf in source_work} & {df.size for df in destination_work}
+  common_sizes.discard(0)
+  source_work = [sf for sf in source_work if sf.size in common_sizes]
+  destination_work = [df for df in destination_work if df.size in common_sizes]
+  logging.info("Size comparison left "+str(len(source_work))+" source and "+str(len(destination_work))+" destination files.")
+
+  # Hardlinked paths share their content, so only one path per inode is hashed
+  source_inodes = group_by_inode(source_work)
+  destination_inodes = group_by_inode(destination_work)
+  source_work = [group[0] for group in source_inodes.values()]
+  destination_work = [group[0] for group in destination_inodes.values()]
+
+  if args.processes:
+    executor = ProcessPoolExecutor(max_workers=max(1, args.jobs), initializer=_init_hash_process)
+  else:
+    executor = ThreadPoolExecutor(max_workers=max(1, args.jobs))
 
-      if hash is not None:
-        destination_hashes[hash] = os.path.abspath(df)
+  try:
+    # Of those, only files whose first and last bytes match need their full hash
+    source_samples = get_sample_hashes(executor, source_work, use_source_cache)
+    destination_samples = get_sample_hashes(executor, destination_work, use_destination_cache)
+    common_samples = set(source_samples.values()) & set(destination_samples.values())
+    source_work = [sf for sf in source_work if source_samples.get(sf) in common_samples]
+    destination_work = [df for df in destination_work if destination_samples.get(df) in common_samples]
+    logging.info("Sample comparison left "+str(len(source_work))+" source and "+str(len(destination_work))+" destination files.")
+
+    source_hashes = dict()      # hash: file
+    destination_hashes = dict() # hash: list of inodes, given as list of their files
+
+    source_plan, source_unhashed_size = plan_hashes(source_work, hash_function_name, use_source_cache)
+    for sf, hash in hash_all(executor, source_plan, source_unhashed_size, hash_function_name, "Source"):
+      source_hashes[hash] = sf
+
+    destination_plan, destination_unhashed_size = plan_hashes(destination_work, hash_function_name, use_destination_cache)
+    for df, hash in hash_all(executor, destination_plan, destination_unhashed_size, hash_function_name, "Destination"):
+      siblings = destination_inodes[_inode_key(df)]
+      destination_hashes.setdefault(hash, []).append(siblings)
+  finally:
+    # keep every hash calculated so far, even if hashing is aborted
+    if interrupted and args.processes:
+      print("Dropping the files still being hashed.")
+      stop_hash_processes(executor)
+    else:
+      if interrupted:
+        # threads cannot be stopped, the files they are hashing are finished and their hashes kept
+        print("Finishing the files still being hashed.")
+      executor.shutdown(cancel_futures=True)
+    store_finished_batches()
+    flush_hashes()
 
   matches = []
   comm_match_filesize = 0
@@ -163,24 +268,29 @@ def main():
   if (args.print_hashes):
     print("-------------------")
     print("Source files: ")
-    for sh in source_hashes:
-      print("  "+str(source_hashes[sh])+":\n   "+str(sh)+"\n    "+str(os.path.getsize(source_hashes[sh])))
+    for sh, sf in source_hashes.items():
+      print("  "+sf.path+":\n   "+str(sh)+"\n    "+str(sf.size))
     print("-------------------")
     print("Destination files: ")
     for dh in destination_hashes:
-      print("  "+str(destination_hashes[dh])+":\n   "+str(dh)+"\n    "+str(os.path.getsize(destination_hashes[dh])))
+      for destination_inode in destination_hashes[dh]:
+        for df in destination_inode:
+          print("  "+df.path+":\n   "+str(dh)+"\n    "+str(df.size))
 
   timestamp_before_compare = time.time()
-  for sh in source_hashes:
-    for dh in destination_hashes:
-      if sh == dh:
-        file_size = os.path.getsize(source_hashes[sh])
-        comm_match_filesize += file_size
-        print("Match found: " + ("%.2f"% (file_size/float(10**9) ) ) + " GB")
-        print("    '"+source_hashes[sh]+"'")
-        print("--->'"+destination_hashes[dh]+"'")
-        matches.append((source_hashes[sh], destination_hashes[dh]))
-  print("Compared "+str(len(source_hashes))+" source files with "+str(len(destination_hashes))+" destination files in " + ("%.1f"% (time.time()-timestamp_before_compare))+"s")
+  for h in source_hashes.keys() & destination_hashes.keys():
+    # the size is known from the walk, matching needs no further stat calls
+    source = source_hashes[h]
+    for destination_inode in destination_hashes[h]:
+      # the space is only freed once all hardlinks of the inode are replaced
+      comm_match_filesize += source.size
+      print("Match found: " + ("%.2f"% (source.size/float(10**9) ) ) + " GB")
+      print("    '"+source.path+"'")
+      for df in destination_inode:
+        print("--->'"+df.path+"'")
+        matches.append((source.path, df.path))
+  destination_file_count = sum(len(inode) for inodes in destination_hashes.values() for inode in inodes)
+  print("Compared "+str(len(source_hashes))+" source files with "+str(destination_file_count)+" destination files in " + ("%.1f"% (time.time()-timestamp_before_compare))+"s")
   print("In total "+str(len(matches))+" Matches found with a total size of " + ("%.2f"% (comm_match_filesize/float(10**9) ) ) + " GB")
   if softlink or hardlink:
     if softlink:
@@ -188,11 +298,10 @@ def main():
     else:
       print("Creating hardlinks...")
     for source, destination in matches:
-      os.unlink(destination)
-      if softlink:
-        os.symlink(source, destination)
-      else:
-        os.link(source, destination)
+      try:
+        relink(source, destination, hardlink)
+      except OSError as error:
+        print(error)
     print("Done.")
   else:
     print("Dry-run done.")
@@ -200,46 +309,75 @@ def main():
     print("  --softlink   to create softlinks")
     print("  --hardlink   to create hardlinks")
 
-def save_hashes(file, data):
-  if os.path.exists(file):
-    logging.debug("Backing up old hashes")
-    backup_path = os.path.join(directory, "hashes_backup.json")
-    if os.path.exists(backup_path):
-      os.remove(backup_path)
-    os.rename(file, backup_path)
-  logging.info("Saving hashes json to "+file)
-  json.dump(data, open(file, 'w'))
-  logging.debug("Saving complete.")
-
-def save_hashes_legacy(file, data):
-  logging.info("Saving hashes pickle to "+file)
-  with open(file, 'wb') as fp:
-    pickle.dump(data, fp, protocol=pickle.HIGHEST_PROTOCOL)
-  logging.debug("Saving complete.")
-
-def load_hashes(file):
-  logging.info("Loading hash cache from json file.")
-  return json.load(open(file, 'r'))
-  
-def load_hashes_legacy(file):
-  logging.info("Loading hashes from pickle file "+file)
-  with open(file, 'rb') as fp:
-    data = pickle.load(fp)
-    return data
-
-def progress_bar(current, total, text, bar_length=20):
-    fraction = current / total
-
-    arrow = int(fraction * bar_length - 1) * '-' + '>'
-    padding = int(bar_length - len(arrow)) * ' '
-
-    ending = '\n' if current == total else '\r'
-
-    print(f'{text}: [{arrow}{padding}] {int(fraction*100)}% {current}/{total}', end=ending)
+def relink(source, destination, hard):
+  # The link is created next to the destination and renamed over it: the destination is replaced atomically
+  # and stays untouched if the link cannot be created (e.g. a hardlink across filesystems).
+  # The temporary name is unique to this run and never replaces an existing file, so only a link
+  # created here is ever renamed or removed.
+  while True:
+    temporary = destination + ".newlink-" + str(os.getpid()) + "-" + os.urandom(4).hex() + ".tmp"
+    try:
+      if hard:
+        os.link(source, temporary)
+      else:
+        os.symlink(source, temporary)
+      break
+    except FileExistsError:
+      continue
+  try:
+    os.replace(temporary, destination)
+  except OSError:
+    os.unlink(temporary)
+    raise
+
+def open_database(file):
+  logging.info("Opening hash cache "+file)
+  # only the main thread accesses the database, the hashing threads never touch it
+  connection = sqlite3.connect(file)
+  connection.execute("PRAGMA journal_mode=WAL")
+  connection.execute("PRAGMA synchronous=NORMAL")
+  # the lookup table of _lookup_hashes is rebuilt for every phase, it does not need to be written to disk
+  connection.execute("PRAGMA temp_store=MEMORY")
+  connection.execute("PRAGMA cache_size=-65536") # 64 MiB of pages, the joins of large trees stay in memory
+  # WITHOUT ROWID stores the rows in the primary key itself instead of keeping every path
+  # a second time in a separate index, which nearly halves the file and saves a lookup per file
+  create_table = ("CREATE TABLE IF NOT EXISTS hashes (algo TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL, "+
+                  "mtime_ns INTEGER NOT NULL, hash TEXT, PRIMARY KEY (algo, path)) WITHOUT ROWID")
+  version = connection.execute("PRAGMA user_version").fetchone()[0]
+  if version < DATABASE_VERSION:
+    connection.execute("BEGIN") # the upgrade is applied completely or not at all
+    has_table = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'hashes'").fetchone() is not None
+    if version < 2:
+      if has_table:
+        # version 1 identified files by size and basename, those entries cannot be trusted
+        logging.info("Discarding hashes of an older cache version.")
+        connection.execute("DROP TABLE hashes")
+    else:
+      if version < 3:
+        # version 2 sampled only the start of the files, those samples were replaced by head and tail samples
+        connection.execute("DELETE FROM hashes WHERE algo = 'blake2b-prefix'")
+      # version 3 used a rowid table
+      logging.info("Converting the hash cache to version "+str(DATABASE_VERSION)+".")
+      connection.execute("ALTER TABLE hashes RENAME TO hashes_old")
+      connection.execute(create_table)
+      connection.execute("INSERT INTO hashes SELECT algo, path, size, mtime_ns, hash FROM hashes_old")
+      connection.execute("DROP TABLE hashes_old")
+    connection.execute(create_table)
+    connection.execute("PRAGMA user_version = "+str(DATABASE_VERSION))
+    connection.commit()
+    if version >= 2:
+      connection.execute("VACUUM") # gives the space of the old table back
+  return connection
+
+def print_hash_progress(label, hashed_size, unhashed_size, time_used):
+    time_used = max(time_used, 1e-6)
+    fraction = hashed_size / unhashed_size
+    time_left = time_used / fraction - time_used
+    print(f"{label}-file hashed so far: {hashed_size / 1e9:.2f}/{unhashed_size / 1e9:.2f} GB ({fraction * 100:.2f}%)"
+          f" avg. Speed: {hashed_size / time_used / 1e6:.2f} MB/s ETA: {calculate_elapsed_time(time_left)}")
 
 def calculate_elapsed_time(time_left):
     formatted_time = timedelta(seconds=time_left)
-    print(formatted_time)
     # Splitting the components
 #    days, hours, minutes, _ = formatted_time.split(":")
     days = formatted_time.days
@@ -262,92 +400,415 @@ def calculate_elapsed_time(time_left):
 
     return elapsed_time_str
 
-def hash_file(file, hash_function=hashlib.sha1):
-  try:
-    filesize = os.path.getsize(file)
-  except:
-    return None
+def new_hash_object(hash_function_name):
+  if hash_function_name == "blake3":
+    return blake3.blake3()
+  # usedforsecurity=False skips FIPS wrappers so OpenSSL can use its fastest (e.g. SHA-NI) implementation
+  return hashlib.new(hash_function_name, usedforsecurity=False)
+
+def hash_file(file, hash_function_name=DEFAULT_HASH_NAME, filesize=None):
+  global liburing
+  if filesize is None:
+    try:
+      filesize = os.path.getsize(file)
+    except:
+      return None
   if filesize <= 0:
     return None
-  BUF_SIZE = 65536  # 64kb chunks
-  parts = math.ceil(filesize / BUF_SIZE)
-  logging.info("Reading file '"+file+"' in "+str(parts)+" parts.")
-  hash_object = hash_function()
-
-  counter = 0
-  text = "'"+os.path.basename(file)+"' hash progress"
-
-  progress_bar(counter, parts, text, bar_length=20)
-
-  start_time = time.time()
+  # per file messages are only formatted with -v, otherwise hash_all reports the progress
+  verbose = logging.getLogger().isEnabledFor(logging.INFO)
+  if verbose:
+    logging.info("Hashing file '"+file+"' ("+str(filesize)+" bytes).")
+    start_time = time.time()
   try:
     with open(file, 'rb') as f:
-        while True:
-          data = f.read(BUF_SIZE)
-          if not data:
-            break
-          hash_object.update(data)
-          if ((counter * 100 // parts) != ((counter+1) * 100 // parts)):
-            progress_bar(counter, parts, text, bar_length=20)
-          counter += 1
-    end_time = time.time()
-    print("Calculating " + hash_function.__name__[8:] + "hash of '"+os.path.basename(file)+"' took "+("%.1f" % (end_time-start_time))+" s. with avg. speed of "+("%.2f" % (os.path.getsize(file)/(end_time-start_time)/float(1<<20)))+" MB/s")
-  except OSError as error:
+      if filesize >= MMAP_THRESHOLD and hasattr(os, "posix_fadvise"):
+        # lets the kernel use a larger read-ahead window
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+      # the strategy is chosen once per file by its size, from largest to smallest
+      if hash_function_name == "blake3" and filesize > TREE_HASH_THRESHOLD:
+        # blake3 is a tree hash, so the chunks of one file can be hashed in parallel
+        hash_object = blake3.blake3(max_threads=blake3.blake3.AUTO)
+        hash_object.update_mmap(file)
+      elif filesize > READ_AHEAD_THRESHOLD:
+        hash_object = None
+        if liburing is not None:
+          try:
+            hash_object = _hash_file_uring(f, hash_function_name)
+            if hash_object is None: # the ring could not be set up, which will not change during this run
+              liburing = None
+          except OSError:
+            raise
+          except Exception as error: # the binding does not behave as expected, it is not used again
+            logging.warning("io_uring failed, reading ahead in a thread instead: "+repr(error))
+            liburing = None
+            f.seek(0)
+        if hash_object is None:
+          hash_object = _hash_file_read_ahead(f, hash_function_name)
+      elif filesize >= MMAP_THRESHOLD:
+        hash_object = _hash_file_mmap(f, hash_function_name)
+      elif filesize <= SINGLE_READ_THRESHOLD:
+        # about twice as fast as file_digest for small files, which allocates a 256kb buffer per call
+        hash_object = new_hash_object(hash_function_name)
+        hash_object.update(f.read())
+      elif sys.version_info >= (3, 11):
+        # file_digest runs the read/update loop in C and releases the GIL
+        hash_object = hashlib.file_digest(f, lambda: new_hash_object(hash_function_name))
+      else:
+        hash_object = _hash_file_loop(f, hash_function_name)
+    if verbose:
+      elapsed = max(time.time() - start_time, 1e-6)
+      logging.info("Calculating " + hash_function_name + " hash of '"+os.path.basename(file)+"' took "+("%.1f" % elapsed)+" s. with avg. speed of "+("%.2f" % (filesize/elapsed/float(1<<20)))+" MB/s")
+  except (OSError, ValueError) as error: # mmap raises ValueError if the file was emptied meanwhile
     print("")
     print(error)
     print("")
     return None
   return hash_object.hexdigest()
 
-def _file_size(file):
-  return os.path.getsize(file)
-
-def safe_file_size(file):
+def hash_file_sample(file, hash_function_name=SAMPLE_HASH_NAME, filesize=None):
+  # Hashes the first and the last SAMPLE_SIZE bytes, files of up to twice that size are hashed completely.
+  # Files that share their beginning (e.g. headers of the same format) mostly differ at the end.
   try:
-    return _file_size(file)
-  except:
-    return 0
+    with open(file, 'rb') as f:
+      hash_object = hashlib.blake2b(f.read(SAMPLE_SIZE), digest_size=16)
+      if filesize is None:
+        filesize = os.fstat(f.fileno()).st_size
+      if filesize > SAMPLE_SIZE:
+        f.seek(max(SAMPLE_SIZE, filesize - SAMPLE_SIZE))
+        hash_object.update(f.read(SAMPLE_SIZE))
+      return hash_object.hexdigest()
+  except OSError as error:
+    print("")
+    print(error)
+    print("")
+    return None
 
-def has_file_hash(file, hash_function_name):
-  filesize = None
+def _hash_file_mmap(f, hash_function_name):
+  # One update over the whole mapping: no copies into python objects, the GIL is released
+  # while hashing and page faults are served by the kernel's read-ahead.
+  hash_object = new_hash_object(hash_function_name)
+  with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+      # page faults of the mapping read further ahead, fadvise on the file does not cover them
+      mapped.madvise(mmap.MADV_SEQUENTIAL)
+    hash_object.update(mapped)
+  return hash_object
+
+def _hash_file_read_ahead(f, hash_function_name):
+  # A reader thread keeps filling buffers while this thread hashes the previous ones.
+  # Both file reads and hash updates release the GIL, so disk latency overlaps with hashing.
+  hash_object = new_hash_object(hash_function_name)
+  free_buffers = queue.Queue()
+  filled_buffers = queue.Queue()
+  for _ in range(READ_AHEAD_DEPTH):
+    free_buffers.put(bytearray(READ_AHEAD_BUF_SIZE))
+
+  def read_ahead():
+    try:
+      while True:
+        buffer = free_buffers.get()
+        length = f.readinto(buffer)
+        filled_buffers.put((buffer, length))
+        if not length:
+          break
+    except OSError as error:
+      filled_buffers.put((error, 0))
+
+  reader = threading.Thread(target=read_ahead, daemon=True)
+  reader.start()
+  while True:
+    buffer, length = filled_buffers.get()
+    if isinstance(buffer, OSError):
+      raise buffer
+    if not length:
+      break
+    hash_object.update(memoryview(buffer)[:length])
+    free_buffers.put(buffer)
+  reader.join()
+  return hash_object
+
+def _hash_file_uring(f, hash_function_name):
+  # Keeps URING_DEPTH reads in flight with io_uring and hashes the chunks in file order as they complete,
+  # until the end of the file. Chunk k is read into buffer k % URING_DEPTH, which is reused for chunk
+  # k + URING_DEPTH once it is hashed.
+  # Returns None if io_uring is not usable (old kernel, blocked by seccomp), the caller then reads ahead in a thread
+  # and does not try io_uring again.
+  ring = liburing.Ring()
+  cqe = liburing.Cqe()
   try:
-    filesize = _file_size(file)
-  except Exception as e:
-    print(e)
-  if filesize is not None:
-    basename = os.path.basename(file)
-    key = f"{filesize} {basename}"
-    return key in hashes[hash_function_name]
-  return False
-
-def get_file_hash(file, hash_function, use_cache):
-  filesize = safe_file_size(file)
-  basename = os.path.basename(file)
-  key = f"{filesize} {basename}"
-  hash_function_name = hash_function.__name__[8:]
-  if use_cache and key in hashes[hash_function_name]:
-    if hashes[hash_function_name][key] is not None:
-      logging.info("Found file hash for "+str(key)+": "+hashes[hash_function_name][key])
-    else:
-      logging.info("Found None-hash for "+str(key))
-    return hashes[hash_function_name][key]
-  hash = hash_file(file, hash_function)
-  #if use_cache:
-  hashes[hash_function_name][key] = hash
-  save_hashes(hash_file_path, hashes)
-  if hash is not None:
-    logging.info("Calculated file hash for "+str(key)+": "+hash)
-  else:
-    logging.info("Could not calculate hash.")
-  return hash
-
-def get_all_files(folder):
+    liburing.io_uring_queue_init(URING_DEPTH, ring)
+  except OSError as error:
+    logging.info("io_uring is not available, reading ahead in a thread instead: "+str(error))
+    return None
+  buffers = [bytearray(READ_AHEAD_BUF_SIZE) for _ in range(URING_DEPTH)]
+  lengths = [None] * URING_DEPTH
+  in_flight = 0
+  try:
+    hash_object = new_hash_object(hash_function_name)
+    fd = f.fileno()
+
+    def submit(chunk):
+      slot = chunk % URING_DEPTH
+      sqe = liburing.io_uring_get_sqe(ring)
+      liburing.io_uring_prep_read(sqe, fd, buffers[slot], chunk * READ_AHEAD_BUF_SIZE)
+      sqe.user_data = slot
+
+    for chunk in range(URING_DEPTH):
+      submit(chunk)
+    in_flight += liburing.io_uring_submit(ring)
+    chunk = 0
+    while True:
+      slot = chunk % URING_DEPTH
+      while lengths[slot] is None:
+        liburing.io_uring_wait_cqe(ring, cqe)
+        entry = cqe[0]
+        in_flight -= 1
+        try:
+          lengths[entry.user_data] = entry.res # raises the OSError of a failed read
+        finally:
+          liburing.io_uring_cqe_seen(ring, entry)
+      length = lengths[slot]
+      lengths[slot] = None
+      offset = chunk * READ_AHEAD_BUF_SIZE
+      while length < READ_AHEAD_BUF_SIZE: # short read, the rest is read directly up to the end of the file
+        rest = os.pread(fd, READ_AHEAD_BUF_SIZE - length, offset + length)
+        if not rest:
+          break
+        buffers[slot][length:length + len(rest)] = rest
+        length += len(rest)
+      hash_object.update(memoryview(buffers[slot])[:length])
+      if length < READ_AHEAD_BUF_SIZE: # end of file
+        return hash_object
+      submit(chunk + URING_DEPTH)
+      in_flight += liburing.io_uring_submit(ring)
+      chunk += 1
+  finally:
+    # queue_exit only unmaps the ring, the kernel would still complete reads in flight (e.g. those past the end
+    # of the file or after an error) into the buffers. They are waited for before the buffers can be freed.
+    try:
+      while in_flight > 0:
+        liburing.io_uring_wait_cqe(ring, cqe)
+        liburing.io_uring_cqe_seen(ring, cqe[0])
+        in_flight -= 1
+    except Exception:
+      _stranded_buffers.append(buffers) # the kernel may still write into them, they are never freed
+    liburing.io_uring_queue_exit(ring)
+
+def _hash_file_loop(f, hash_function_name):
+  # Fallback for python < 3.11, which lacks hashlib.file_digest.
+  # The progress is reported per file by hash_all, not from within this loop.
+  BUF_SIZE = 1 << 20  # 1mb chunks, large enough to amortize the overhead of each update call
+  hash_object = new_hash_object(hash_function_name)
+  # one buffer is filled again and again instead of allocating a new bytes object per chunk
+  buffer = bytearray(BUF_SIZE)
+  view = memoryview(buffer)
+  while True:
+    length = f.readinto(buffer)
+    if not length:
+      break
+    hash_object.update(view[:length])
+  return hash_object
+
+def _cache_key(file):
+  # a cached hash is only valid while the file keeps its size and modification time
+  return (file.path, file.size, file.mtime_ns)
+
+def _lookup_hashes(files, hash_function_name):
+  # Looks up all files with a single join inside sqlite instead of one query per file.
+  # Returns a dict path: hash of the files with a valid cache entry.
+  database.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)")
+  database.execute("DELETE FROM lookup")
+  database.executemany("INSERT OR IGNORE INTO lookup (path, size, mtime_ns) VALUES (?, ?, ?)", map(_cache_key, files))
+  return dict(database.execute("SELECT lookup.path, hashes.hash FROM lookup JOIN hashes ON hashes.algo = ? AND hashes.path = lookup.path "+
+                               "AND hashes.size = lookup.size AND hashes.mtime_ns = lookup.mtime_ns", (hash_function_name,)))
+
+def plan_hashes(files, hash_function_name, use_cache):
+  # Looks up every file in the cache once. Returns a list of (file, needs_hash, cached hash)
+  # and the total size of the files that need to be hashed.
+  cached = _lookup_hashes(files, hash_function_name) if use_cache else dict()
+  verbose = logging.getLogger().isEnabledFor(logging.INFO)
+  plan = []
+  unhashed_size = 0
+  for file in files:
+    if file.path not in cached:
+      plan.append((file, True, None))
+      unhashed_size += file.size
+      continue
+    hash = cached[file.path]
+    if verbose:
+      if hash is not None:
+        logging.info("Found file hash for "+str(_cache_key(file))+": "+hash)
+      else:
+        logging.info("Found None-hash for "+str(_cache_key(file)))
+    plan.append((file, False, hash))
+  return plan, unhashed_size
+
+def _hash_batch(batch, hash_function_name, calculate=hash_file):
+  # Runs in a worker thread or process and does not touch the cache. Returns a list of (file, hash, calculated).
+  # the cache key is only formatted for the log when it is shown
+  verbose = logging.getLogger().isEnabledFor(logging.INFO)
+  results = []
+  for file in batch:
+    hash = calculate(file.path, hash_function_name, file.size)
+    if verbose:
+      if hash is not None:
+        logging.info("Calculated file hash for "+str(_cache_key(file))+": "+hash)
+      else:
+        logging.info("Could not calculate hash.")
+    results.append((file, hash, True))
+  return results
+
+def _init_hash_process():
+  # Ctrl+C reaches the whole process group, only the main process saves the cache and exits
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def hash_files_batch(executor, plan, hash_function_name, calculate=hash_file, max_size=BATCH_FILE_SIZE):
+  # Small files (all files if max_size is None) are handed to the workers in batches of BATCH_LENGTH,
+  # so the executor overhead is paid per batch instead of per file. Cached files never reach the workers.
+  # Yields (file, hash, calculated).
+  batches = []
+  batch = []
+  for file, needs_hash, hash in plan:
+    if not needs_hash:
+      yield file, hash, False
+      continue
+    if max_size is not None and file.size > max_size:
+      batches.append([file])
+      continue
+    batch.append(file)
+    if len(batch) == BATCH_LENGTH:
+      batches.append(batch)
+      batch = []
+  if batch:
+    batches.append(batch)
+  futures = [executor.submit(_hash_batch, batch, hash_function_name, calculate) for batch in batches]
+  for future in futures:
+    unconsumed_batches[future] = hash_function_name
+  for future in futures:
+    yield from future.result()
+    del unconsumed_batches[future]
+
+def store_finished_batches():
+  # Stores the hashes of batches that finished but were not consumed because hashing was aborted.
+  # Storing a hash that was already stored from a partly consumed batch again does no harm.
+  for future, hash_function_name in unconsumed_batches.items():
+    if future.done() and not future.cancelled() and future.exception() is None:
+      for file, hash, calculated in future.result():
+        if calculated:
+          store_file_hash(file, hash_function_name, hash)
+  unconsumed_batches.clear()
+
+def stop_hash_processes(executor):
+  # Queued batches are cancelled and the workers are terminated instead of finishing their files
+  if hasattr(executor, "terminate_workers"): # python 3.14
+    executor.terminate_workers()
+    return
+  processes = list((executor._processes or {}).values())
+  manager = executor._executor_manager_thread
+  executor.shutdown(wait=False, cancel_futures=True)
+  for process in processes:
+    process.terminate()
+  if manager is not None:
+    # the management thread notices the terminated workers and cleans up, it has to be done before the
+    # interpreter exits or its exit handler can write to pipes the thread just closed
+    manager.join()
+
+def hash_all(executor, plan, unhashed_size, hash_function_name, label):
+  # Hashes the planned files, caches new hashes and reports the progress. Yields (file, hash) for every hashable file.
+  hashed_size = 0
+  start_time = time.time()
+  last_print = 0
+  for file, hash, add in hash_files_batch(executor, plan, hash_function_name):
+    if add:
+      store_file_hash(file, hash_function_name, hash)
+      hashed_size += file.size
+      now = time.time()
+      if now - last_print > PROGRESS_INTERVAL or hashed_size == unhashed_size:
+        last_print = now
+        print_hash_progress(label, hashed_size, unhashed_size, now - start_time)
+    if hash is not None:
+      yield file, hash
+
+def store_file_hash(file, hash_function_name, hash):
+  database.execute("INSERT OR REPLACE INTO hashes (algo, path, size, mtime_ns, hash) VALUES (?, ?, ?, ?, ?)",
+                   (hash_function_name, *_cache_key(file), hash))
+  global unsaved_hashes
+  unsaved_hashes += 1
+  if unsaved_hashes >= SAVE_INTERVAL or time.time() - last_save > SAVE_SECONDS:
+    flush_hashes()
+
+def get_sample_hashes(executor, files, use_cache):
+  samples = dict() # file: (size, sample hash)
+  plan, _ = plan_hashes(files, SAMPLE_HASH_NAME, use_cache)
+  for file, sample, add in hash_files_batch(executor, plan, SAMPLE_HASH_NAME, hash_file_sample, max_size=None):
+    if add:
+      store_file_hash(file, SAMPLE_HASH_NAME, sample)
+    if sample is not None:
+      samples[file] = (file.size, sample)
+  return samples
+
+def _exit_on_interrupt(signum, frame):
+  global interrupted
+  interrupted = True
+  print("")
+  print("Interrupted, saving the hashes calculated so far.")
+  flush_hashes()
+  sys.exit(130)
+
+def flush_hashes():
+  global unsaved_hashes, last_save
+  if unsaved_hashes > 0:
+    logging.info("Saving "+str(unsaved_hashes)+" new hashes to "+hash_db_path)
+    database.commit()
+    unsaved_hashes = 0
+  last_save = time.time()
+
+def _inode_key(file):
+  # st_ino is 0 where the platform does not report inodes, those files are identified by their real path
+  return (file.dev, file.ino) if file.ino else os.path.realpath(file.path)
+
+def group_by_inode(files):
+  groups = dict() # (dev, ino): list of files
+  for file in files:
+    groups.setdefault(_inode_key(file), []).append(file)
+  return groups
+
+def get_all_files(folder, follow_symlinks=False, min_size=0, extensions=None):
+  # extensions: set of lower case extensions including the dot, None for all files
   if type(folder) is list:
-    return [file for f in folder for file in get_all_files(f)]
+    return [file for f in folder for file in get_all_files(f, follow_symlinks, min_size, extensions)]
   l = []
-  for path, subdirs, files in os.walk(folder):
-    for name in files:
-      l.append(os.path.join(path, name))
+  # scandir hands out the file type with the directory listing, so every file is stat'ed once
+  # and files filtered by type or name are never stat'ed at all
+  folders = [os.path.abspath(folder)]
+  while folders:
+    try:
+      entries = os.scandir(folders.pop())
+    except OSError as error:
+      logging.warning(error)
+      continue
+    with entries:
+      for entry in entries:
+        try:
+          is_symlink = entry.is_symlink()
+          if is_symlink and not follow_symlinks:
+            continue
+          if entry.is_dir():
+            if not is_symlink:
+              folders.append(entry.path)
+            continue
+        except OSError:
+          continue
+        if extensions is not None and os.path.splitext(entry.name)[1].lower() not in extensions:
+          continue
+        try:
+          stat = entry.stat()
+          if stat.st_size < min_size:
+            continue
+          l.append(FileEntry(entry.path, stat.st_size, stat.st_nlink, is_symlink, stat.st_mtime_ns, stat.st_dev, stat.st_ino))
+        except OSError: # e.g. broken symlinks
+          continue
   logging.info("Found "+str(len(l))+" files in '"+folder+"'")
   return l
 
@@ -356,17 +817,19 @@ def get_all_files(folder):
 
 directory = os.path.dirname(os.path.realpath(__file__))
 
-hash_file_path = os.path.join(directory, "hashes.json")
-hash_file_path_legacy = os.path.join(directory, "hashes.p")
+hash_db_path = os.path.join(directory, "hashes.sqlite")
+hash_file_path = os.path.join(directory, "hashes.json") # legacy json cache
+DATABASE_VERSION = 4
 
-migrate_database()
+SAVE_INTERVAL = 500 # newly calculated hashes between two commits of the cache
+SAVE_SECONDS = 30 # ... or seconds, so the hashes of a few large files are not lost on a crash
+unsaved_hashes = 0
+last_save = time.time()
 
-if os.path.exists(hash_file_path):
-  hashes = load_hashes(hash_file_path) # dict ( hash_function: dict( (name, size): hash))
-else:
-  hashes = dict()
+database = None # sqlite3 connection, opened in main
 
-logging.info("Loaded "+str(sum([len(hashes[name]) for name in hashes]))+" previously calculated hashes.")
+unconsumed_batches = dict() # future: hash function name, batches handed to the workers whose hashes are not stored yet
+interrupted = False # set by Ctrl+C
 
 
 if __name__ == "__main__":